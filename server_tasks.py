@@ -2,16 +2,28 @@
 # Flask + SQLAlchemy (SQLite em /instance)
 
 import os
-import json
+import queue
+import sys
+import time
 import datetime
-from collections import defaultdict
-from queue import Queue
-
+import functools
+import hashlib
+import itertools
+import threading
+import zlib
+from collections import deque
+
+import orjson
 from flask import (
-    Flask, request, jsonify, render_template_string, render_template,
-    redirect, url_for, session, abort, Response
+    Flask, request, jsonify, render_template,
+    redirect, url_for, session, abort, Response, g, stream_with_context
 )
+from flask.json.provider import JSONProvider
+from flask.sessions import SecureCookieSessionInterface
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import bindparam, delete, event, func, insert, select, tuple_, update
+from sqlalchemy.orm import joinedload
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # =============================
@@ -24,17 +36,122 @@ DB_FILENAME = os.environ.get("PANEL_DB_FILENAME", "painel_tarefas.db")
 db_path = os.path.join(app.instance_path, DB_FILENAME)
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# pool real para threads concorrentes (SSE + API); timeout = espera do lock de escrita do SQLite
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "connect_args": {"check_same_thread": False, "timeout": 15},
+}
 
 app.secret_key = os.environ.get("PANEL_SECRET", "trocar-isso-em-producao")
+
+# bytecode dos templates de templates/ sobrevive a reinícios do processo
+_jinja_cache_dir = os.path.join(app.instance_path, "jinja_cache")
+os.makedirs(_jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
 db = SQLAlchemy(app)
 
+# WAL + synchronous=NORMAL: leitores (SSE/calendário) não bloqueiam o writer e o commit faz menos fsync
+def _sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.close()
+
+with app.app_context():
+    event.listen(db.engine, "connect", _sqlite_pragmas)
+
+# =============================
+# JSON (orjson em vez do json da stdlib)
+# =============================
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # bytes do orjson direto no corpo: sem o round-trip str -> bytes do dumps()
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=str), mimetype="application/json")
+
+app.json = OrjsonProvider(app)
+
+# cookie de sessão: só guarda user_id, então orjson basta (sem as tags do TaggedJSONSerializer)
+class _OrjsonSessionSerializer:
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+class OrjsonSessionInterface(SecureCookieSessionInterface):
+    serializer = _OrjsonSessionSerializer()
+    digest_method = staticmethod(hashlib.blake2s)
+
+app.session_interface = OrjsonSessionInterface()
+
+# =============================
+# SENHAS
+# =============================
+_PWD_DEFAULT = "scrypt:32768:8:1"  # padrão do Werkzeug
+# piso por algoritmo (custos padrão do Werkzeug 3): o env pode subir o custo, nunca baixar
+_PWD_FLOOR = {"scrypt": (32768, 8, 1), "pbkdf2": (600000,)}
+# ordem de força entre algoritmos: nunca regrava um hash num algoritmo mais fraco
+_PWD_RANK = {"pbkdf2": 0, "scrypt": 1}
+
+def _pwd_cost(method):
+    # "scrypt:n:r:p" / "pbkdf2:hash:iterações" -> (algoritmo, parâmetros numéricos); omitidos = padrão do Werkzeug
+    parts = method.split(":")
+    try:
+        if parts[0] == "scrypt" and len(parts) in (1, 4):
+            return "scrypt", tuple(int(x) for x in parts[1:]) or _PWD_FLOOR["scrypt"]
+        if parts[0] == "pbkdf2" and len(parts) <= 3:
+            return "pbkdf2", (int(parts[2]),) if len(parts) == 3 else _PWD_FLOOR["pbkdf2"]
+    except ValueError:
+        pass
+    return None, ()
+
+def _pwd_below(cost, floor):
+    return any(have < want for have, want in zip(cost, floor))
+
+PASSWORD_METHOD = os.environ.get("PANEL_PASSWORD_METHOD", _PWD_DEFAULT)
+_PWD_TARGET = _pwd_cost(PASSWORD_METHOD)
+if _PWD_TARGET[0] is None or _pwd_below(_PWD_TARGET[1], _PWD_FLOOR[_PWD_TARGET[0]]):
+    # método ilegível ou abaixo do piso: volta ao padrão em vez de gravar hashes mais fracos
+    app.logger.warning("PANEL_PASSWORD_METHOD=%r abaixo do padrão do Werkzeug; usando %s", PASSWORD_METHOD, _PWD_DEFAULT)
+    PASSWORD_METHOD = _PWD_DEFAULT
+    _PWD_TARGET = _pwd_cost(PASSWORD_METHOD)
+
+def hash_password(pwd_plain):
+    return generate_password_hash(pwd_plain, method=PASSWORD_METHOD)
+
+def password_needs_rehash(pwd_hash):
+    # só regrava o que está abaixo do alvo: algoritmo mais fraco ou algum parâmetro de custo menor
+    algo, cost = _pwd_cost(pwd_hash.split("$", 1)[0])
+    target_algo, target_cost = _PWD_TARGET
+    if algo is None:
+        return False
+    if algo != target_algo:
+        return _PWD_RANK[algo] < _PWD_RANK[target_algo]
+    return _pwd_below(cost, target_cost)
+
 # =============================
 # MODELS
 # =============================
+def _username_ci_default(ctx):
+    return ctx.get_current_parameters()["username"].lower()
+
 class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
+    # chave de busca sem diferenciar maiúsculas ("ana" == "Ana"); preenchida no INSERT
+    username_ci = db.Column(db.String(80), unique=True, index=True, default=_username_ci_default)
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), default="user")
     client_token = db.Column(db.String(100), nullable=True)
@@ -45,6 +162,10 @@ class User(db.Model):
 
 class Task(db.Model):
     __tablename__ = "tasks"
+    __table_args__ = (
+        db.Index("ix_task_assignee_due", "assigned_to_id", "due_date"),
+        db.Index("ix_tasks_user_active_created", "assigned_to_id", "active", "created_at"),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     title = db.Column(db.String(200), nullable=False)
@@ -56,13 +177,20 @@ class Task(db.Model):
     status = db.Column(db.String(30), default="pendente")  # pendente, em_andamento, concluida
     active = db.Column(db.Boolean, default=True)
 
-    due_date = db.Column(db.DateTime, nullable=True)
+    due_date = db.Column(db.DateTime, nullable=True, index=True)
 
-    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # índice: a página do dashboard (ORDER BY created_at DESC LIMIT/OFFSET) anda no índice, sem ordenar a tabela
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
 
+    # só leitura (logs entram via _STMT_INSERT_LOG); mais recentes primeiro
+    logs = db.relationship("TaskLog", order_by="TaskLog.executed_at.desc()", viewonly=True)
+
 class TaskLog(db.Model):
     __tablename__ = "task_logs"
+    __table_args__ = (
+        db.Index("ix_tasklog_task_exec", "task_id", "executed_at"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     task_id = db.Column(db.Integer, db.ForeignKey("tasks.id"), nullable=False)
     host_id = db.Column(db.String(100), nullable=False)
@@ -70,96 +198,332 @@ class TaskLog(db.Model):
     message = db.Column(db.Text, nullable=True)
     executed_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
+# =============================
+# CONSULTAS FREQUENTES
+# =============================
+# statements montados uma vez no import; só o parâmetro muda entre requests,
+# então a chave do cache de compilação do SQLAlchemy é sempre a mesma
+# página de /user_tasks; id desempata created_at para a paginação por chave (keyset) ser estável
+_STMT_USER_TASKS = (
+    select(Task)
+    .where(Task.active.is_(True), Task.assigned_to_id == bindparam("uid"))
+    .order_by(Task.created_at.desc(), Task.id.desc())
+    .limit(bindparam("lim"))
+)
+# páginas seguintes: continua logo abaixo da última linha mostrada, sem OFFSET
+_STMT_USER_TASKS_BEFORE = _STMT_USER_TASKS.where(
+    tuple_(Task.created_at, Task.id) < tuple_(bindparam("c"), bindparam("before"))
+)
+_STMT_NOTIFY_TASKS = (
+    select(Task.id, Task.title, Task.description, Task.status, Task.created_at, Task.due_date)
+    .where(Task.active.is_(True), Task.assigned_to_id == bindparam("uid"))
+    .order_by(Task.created_at.desc())
+)
+# logs são só-append e nunca relidos no mesmo request: INSERT direto, sem unit of work
+_STMT_INSERT_LOG = insert(TaskLog)
+_STMT_TASK_LOGS = (
+    select(TaskLog.id, TaskLog.task_id, TaskLog.host_id, TaskLog.status, TaskLog.message, TaskLog.executed_at)
+    .where(TaskLog.task_id == bindparam("tid"))
+    .order_by(TaskLog.executed_at.asc())
+)
+
+# versões baratas para ETag: todo UPDATE passa por onupdate de updated_at,
+# DELETE muda o COUNT; logs são só-append (COUNT + MAX(id) bastam)
+# recorte por usuário: tarefa que entra no conjunto traz updated_at novo, a que sai muda o COUNT
+_STMT_USER_TASKS_VERSION = (
+    select(func.count(), func.max(Task.updated_at))
+    .where(Task.assigned_to_id == bindparam("uid"))
+)
+_STMT_LOGS_VERSION = (
+    select(func.count(), func.max(TaskLog.id))
+    .where(TaskLog.task_id == bindparam("tid"))
+)
+
 # =============================
 # SIMPLE PUBSUB (SSE)
 # =============================
-subscribers = defaultdict(list)  # username -> [Queue, ...]
+SSE_QUEUE_MAX = 256     # frames pendentes por conexão antes de considerá-la lenta
+SSE_HISTORY_MAX = 512   # frames recentes por usuário para replay via Last-Event-ID
+SSE_KEEPALIVE = 15.0    # segundos sem eventos até mandar um comentário de keepalive
+SSE_REPLAY_WINDOW = 60.0  # segundos que o histórico sobrevive sem stream aberto (tempo para o EventSource reconectar)
+
+# frames fixos já em bytes: o stream inteiro trafega bytes, sem encode por chunk
+_SSE_HELLO = b'event: hello\ndata: {"ok": true}\n\n'
+_SSE_PING = b": keepalive\n\n"
+_SSE_USER_NOT_FOUND = b'event: error\ndata: {"error":"user_not_found"}\n\n'
+
+class _Subscriber:
+    # fila de um produtor/um consumidor: deque (append/popleft atômicos) + Event para acordar
+    __slots__ = ("dq", "ev", "overflow")
+
+    def __init__(self):
+        self.dq = deque()
+        self.ev = threading.Event()
+        self.overflow = False
+
+    def put(self, frame):
+        if len(self.dq) >= SSE_QUEUE_MAX:
+            # cliente lento: encerra o stream; o EventSource reconecta e recupera pelo histórico
+            self.overflow = True
+        else:
+            self.dq.append(frame)
+        self.ev.set()
+
+subscribers = {}  # username -> {_Subscriber, ...}
+_history = {}     # username -> deque[(event_id, frame)], criado na primeira conexão do usuário
+_idle_since = {}  # username -> monotonic de quando o último stream fechou; some ao reconectar
+_sub_lock = threading.Lock()
+_event_ids = itertools.count(1)
+
+# fan-out fora da thread do request: o handler só enfileira; uma thread única
+# numera, guarda no histórico e distribui (ordem dos ids == ordem de entrega)
+_pub_q = queue.SimpleQueue()
+_pump = None
+_pump_lock = threading.Lock()
+
+def _sse_pump():
+    while True:
+        username, data = _pub_q.get()
+        eid = next(_event_ids)
+        frame = b"id: %d\nevent: task\ndata: " % eid + data + b"\n\n"
+        with _sub_lock:
+            hist = _history.get(username)
+            if hist is None:
+                continue
+            hist.append((eid, frame))
+            subs = tuple(subscribers.get(username, ()))
+        for sub in subs:
+            try:
+                sub.put(frame)
+            except Exception:
+                app.logger.exception("SSE: falha ao entregar evento para %s", username)
+
+def _ensure_pump():
+    # iniciada sob demanda: sobrevive a servidores que fazem fork depois do import
+    global _pump
+    with _pump_lock:
+        if _pump is None or not _pump.is_alive():
+            _pump = threading.Thread(target=_sse_pump, name="sse-pump", daemon=True)
+            _pump.start()
+
+def sse_wants_events(username):
+    # stream aberto agora, ou fechado há menos de SSE_REPLAY_WINDOW (o replay via Last-Event-ID
+    # ainda pode pedir o evento); passada a janela, o histórico é descartado e o usuário volta
+    # a "ninguém ouvindo", então create/edit/alert deixam de montar evento para ele
+    if username not in _history:
+        return False
+    since = _idle_since.get(username)
+    if since is None or time.monotonic() - since < SSE_REPLAY_WINDOW:
+        return True
+    with _sub_lock:
+        # confere de novo sob o lock: uma reconexão no meio do caminho tira o usuário de _idle_since
+        if _idle_since.get(username) == since:
+            del _idle_since[username]
+            del _history[username]
+    return username in _history
+
+# evento fixo do painel admin, já serializado: publicado a cada alteração de tarefa
+_EV_CHANGED = orjson.dumps({"type": "changed"})
 
 def sse_publish(username, event):
-    for q in list(subscribers.get(username, [])):
-        try:
-            q.put_nowait(event)
-        except Exception:
-            pass
+    if not sse_wants_events(username):
+        return  # ninguém ouvindo nem para reconectar: nem serializa
+    if _pump is None or not _pump.is_alive():
+        _ensure_pump()  # também reergue a thread morta (ou que ficou no pai depois de um fork)
+    # serializa uma única vez, ainda no request (o dict pode mudar depois); bytes já vêm prontos
+    _pub_q.put((username, event if isinstance(event, bytes) else orjson.dumps(event)))
+
+def broadcast_observation(target, obs_event, alert_event):
+    # mesmo evento para o responsável e o admin: serializa uma vez só
+    users = [n for n in dict.fromkeys((target, "admin")) if sse_wants_events(n)]
+    if users:
+        if _pump is None or not _pump.is_alive():
+            _ensure_pump()
+        data = orjson.dumps(obs_event)
+        for n in users:
+            _pub_q.put((n, data))
+    sse_publish(target, alert_event)
+
+def _observation_events(t, author, message):
+    # montado antes do commit: depois dele t expira e cada atributo custaria um SELECT
+    target = t.assigned_to.username if t.assigned_to else "admin"
+    obs = {"type": "new_observation", "task_id": t.id, "message": message, "user": author}
+    alert = {"type": "alert", "task": {
+        "id": t.id,
+        "title": f"[OBS] Nova interação na tarefa #{t.id}",
+        "description": (message or "")[:280],
+        "status": t.status,
+        "due_date": t.due_date.isoformat() if t.due_date else None
+    }}
+    return target, obs, alert
+
+def _task_event(kind, t):
+    # também montado antes do commit (o id já existe após flush)
+    return {"type": kind, "task": {
+        "id": t.id, "title": t.title, "description": t.description or "",
+        "status": t.status, "due_date": t.due_date.isoformat() if t.due_date else None
+    }}
+
+def _gzip_stream(chunks):
+    # gzip contínuo; Z_SYNC_FLUSH entrega cada frame ao cliente sem esperar o próximo
+    z = zlib.compressobj(1, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            yield z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+        yield z.flush()  # fim do stream: fecha o membro gzip (trailer com CRC)
+    finally:
+        chunks.close()
 
 @app.route("/api/stream")
 def api_stream():
-    username = request.args.get("username", "").strip()
+    # o painel já traz a identidade no cookie de sessão; a extensão manda ?username=
+    session_user = session.get("username")
+    username = request.args.get("username", "").strip() or session_user
     if not username:
         return "username é obrigatório", 400
 
-    user = User.query.filter_by(username=username).first()
-    if username != "admin" and not user:
-        def _end():
-            yield "event: error\ndata: {\"error\":\"user_not_found\"}\n\n"
-        return Response(_end(), mimetype="text/event-stream")
+    if username != session_user:
+        # assinaturas ficam sob o nome canônico, o mesmo usado por sse_publish
+        row = _user_by_username(username)
+        if row:
+            username = row.username
+        elif username.lower() == "admin":
+            username = "admin"
+        else:
+            def _end():
+                yield _SSE_USER_NOT_FOUND
+            return Response(_end(), mimetype="text/event-stream")
 
-    q = Queue()
-    subscribers[username].append(q)
+    last_id = request.headers.get("Last-Event-ID", "").strip()
+    last_id = int(last_id) if last_id.isdigit() else None
 
     def stream():
-        yield 'event: hello\ndata: {"ok": true}\n\n'
+        sub = _Subscriber()
+        with _sub_lock:
+            hist = _history.setdefault(username, deque(maxlen=SSE_HISTORY_MAX))
+            _idle_since.pop(username, None)
+            if last_id is not None:
+                sub.dq.extend(frame for eid, frame in hist if eid > last_id)
+                if sub.dq:
+                    sub.ev.set()
+            subscribers.setdefault(username, set()).add(sub)
         try:
-            while True:
-                ev = q.get()
-                yield f"event: task\ndata: {json.dumps(ev, default=str)}\n\n"
+            yield _SSE_HELLO
+            while not sub.overflow:
+                if not sub.ev.wait(SSE_KEEPALIVE):
+                    # conexão ociosa: o write falha se o cliente sumiu e libera a thread
+                    yield _SSE_PING
+                    continue
+                sub.ev.clear()  # antes de drenar: um put concorrente reativa o Event
+                # rajada acumulada vai num write só (e num flush só do gzip)
+                frames = []
+                while sub.dq:
+                    frames.append(sub.dq.popleft())
+                if frames:
+                    yield b"".join(frames)
         except GeneratorExit:
             pass
         finally:
-            try:
-                subscribers[username].remove(q)
-            except ValueError:
-                pass
+            with _sub_lock:
+                subs = subscribers.get(username)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del subscribers[username]
+                        _idle_since[username] = time.monotonic()  # começa a janela de replay
 
     headers = {
         "Cache-Control": "no-cache",
         "X-Accel-Buffering": "no",
-        "Access-Control-Allow-Origin": "*",
+        "Vary": "Accept-Encoding",
     }
-    return Response(stream(), headers=headers, mimetype="text/event-stream")
+    body = stream()
+    if request.accept_encodings["gzip"]:  # qualidade > 0; "gzip;q=0" fica sem compressão
+        headers["Content-Encoding"] = "gzip"
+        body = _gzip_stream(body)
+    return Response(body, headers=headers, mimetype="text/event-stream")
 
 # =============================
 # DB INIT / MIGRAÇÃO LEVE
 # =============================
 def create_or_update_user(username, password, role="user", host_id=None):
-    u = User.query.filter_by(username=username).first()
+    u = User.query.filter_by(username_ci=username.strip().lower()).first()
     if u:
-        u.password_hash = generate_password_hash(password)
+        u.password_hash = hash_password(password)
         u.role = role
         u.host_id = host_id
     else:
         u = User(
             username=username,
-            password_hash=generate_password_hash(password),
+            password_hash=hash_password(password),
             role=role,
             host_id=host_id,
             client_token=None,
         )
         db.session.add(u)
     db.session.commit()
+    _invalidate_user_cache()
     return u
 
-def _ensure_column(table, colname, decl_sqlite):
+def _ensure_columns(table, specs):
+    # um único PRAGMA por tabela; specs = [(coluna, declaração sqlite), ...]
     try:
         from sqlalchemy import text
-        cols = db.session.execute(text(f"PRAGMA table_info({table})")).fetchall()
-        names = [c[1] for c in cols]
-        if colname not in names:
-            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {decl_sqlite}"))
+        names = {c[1] for c in db.session.execute(text(f"PRAGMA table_info({table})")).fetchall()}
+        added = False
+        for colname, decl_sqlite in specs:
+            if colname not in names:
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {decl_sqlite}"))
+                added = True
+        if added:
             db.session.commit()
     except Exception:
-        pass
+        db.session.rollback()
+
+def _ensure_indexes():
+    # create_all não cria índices novos em tabelas que já existem
+    for model in (User, Task, TaskLog):
+        for ix in model.__table__.indexes:
+            try:
+                ix.create(db.engine, checkfirst=True)
+            except Exception:
+                # ex.: UNIQUE de username_ci com dois usuários que só diferem na caixa
+                app.logger.exception("Não foi possível criar o índice %s", ix.name)
+
+def _backfill_username_ci():
+    db.session.execute(
+        update(User).where(User.username_ci.is_(None)).values(username_ci=func.lower(User.username))
+    )
+    db.session.commit()
+
+SEED_USERS = ("Yasmin", "Hiasmin", "Ana", "Daniela")
 
 def init_db():
     db.create_all()
-    _ensure_column("tasks", "description", "description TEXT")
-    _ensure_column("tasks", "due_date", "due_date TEXT")
-    if not User.query.filter_by(username="admin").first():
-        db.session.add(User(username="admin", password_hash=generate_password_hash("admin123"), role="admin"))
+    _ensure_columns("tasks", [
+        ("description", "description TEXT"),
+        ("due_date", "due_date TEXT"),
+    ])
+    _ensure_columns("users", [
+        ("username_ci", "username_ci VARCHAR(80)"),
+    ])
+    _backfill_username_ci()
+    _ensure_indexes()
+    existing = set(db.session.scalars(
+        select(User.username_ci).where(User.username_ci.in_([n.lower() for n in ("admin",) + SEED_USERS]))
+    ))
+    new_users = []
+    if "admin" not in existing:
+        new_users.append(User(username="admin", password_hash=hash_password("admin123"), role="admin"))
+    missing = [n for n in SEED_USERS if n.lower() not in existing]
+    if missing:
+        # todos compartilham a senha padrão: um hash só
+        seed_hash = hash_password("1234")
+        new_users.extend(User(username=n, password_hash=seed_hash, role="user") for n in missing)
+    if new_users:
+        db.session.add_all(new_users)
         db.session.commit()
-    for uname in ["Yasmin", "Hiasmin", "Ana", "Daniela"]:
-        if not User.query.filter_by(username=uname).first():
-            create_or_update_user(uname, "1234", role="user")
+        _invalidate_user_cache()
 
 # =============================
 # HELPERS (SESSÃO)
@@ -168,128 +532,225 @@ def require_login():
     return "user_id" in session
 
 def current_user():
+    # linha leve (id, username, role) em vez do objeto ORM; 1 SELECT por request
     if "user_id" not in session:
         return None
-    return db.session.get(User, session["user_id"])
+    if "_cached_user" not in g:
+        g._cached_user = db.session.execute(
+            select(User.id, User.username, User.role).where(User.id == session["user_id"])
+        ).first()
+    return g._cached_user
 
 def is_admin():
-    u = current_user()
+    u = current_user()  # reaproveita a linha cacheada em g
     return (u is not None and u.role == "admin")
 
 # =============================
-# TEMA BÁSICO (LOGIN/DASH/USER)
+# CACHE DE USUÁRIOS (username -> id/role)
 # =============================
-THEME_CSS = """
-:root[data-theme="light"]{
-  --bg:#ffffff; --surface:#ffffff; --surface-2:#f7f8fa;
-  --text:#111; --muted:#666; --stroke:#e8eaee; --shadow:rgba(0,0,0,.06);
-  --button:#111; --button-text:#fff; --chip:#f2f4f7; --chip-text:#333;
-}
-:root[data-theme="dark"]{
-  --bg:#0b0f14; --surface:#11161d; --surface-2:#0f141b;
-  --text:#fff; --muted:#9ba4b0; --stroke:#1f2733; --shadow:rgba(0,0,0,.5);
-  --button:#e6e6e6; --button-text:#111; --chip:#1b2330; --chip-text:#d7dfeb;
-}
-html,body{height:100%}
-body{margin:0;background:var(--bg);color:var(--text);
-  font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Helvetica,Arial,sans-serif;
-  transition:background .2s ease,color .2s ease;}
-.container{max-width:1160px;margin:24px auto 40px;padding:0 16px;}
-.topbar{display:flex;gap:12px;align-items:center;justify-content:space-between;flex-wrap:wrap;
-  background:var(--surface);border:1px solid var(--stroke);border-radius:12px;padding:12px 16px;
-  box-shadow:0 10px 30px var(--shadow);}
-.title{font-weight:700;letter-spacing:.2px}
-.top-right{display:flex;gap:12px;align-items:center;flex-wrap:wrap;color:var(--muted);font-size:.9rem}
-.top-right b{color:var(--text)}
-.top-links a{color:var(--muted);text-decoration:none;border:1px solid var(--stroke);padding:6px 10px;border-radius:10px}
-.btn-theme{border:1px solid var(--stroke);background:var(--surface-2);color:var(--text);padding:8px 12px;border-radius:10px;font-weight:600;cursor:pointer}
-.card{background:var(--surface);border:1px solid var(--stroke);border-radius:12px;box-shadow:0 10px 30px var(--shadow);padding:16px}
-label{display:block;font-size:.8rem;color:var(--muted);margin-bottom:6px}
-input,textarea,select{width:100%;background:var(--surface-2);border:1px solid var(--stroke);border-radius:10px;padding:10px 12px;font-size:.9rem;color:var(--text);outline:none}
-input:focus,textarea:focus,select:focus{box-shadow:0 0 0 3px rgba(100,150,250,.18)}
-.btn{background:var(--button);color:var(--button-text);border:none;border-radius:10px;padding:10px 12px;font-weight:700;cursor:pointer}
-.table-wrap{overflow:auto;border:1px solid var(--stroke);border-radius:10px;background:var(--surface-2)}
-table{width:100%;border-collapse:collapse;min-width:760px}
-th{background:var(--surface-2);color:var(--muted);font-weight:600;padding:10px 12px;border-bottom:1px solid var(--stroke);text-align:left;white-space:nowrap}
-td{padding:10px 12px;border-bottom:1px solid var(--stroke);vertical-align:top}
-.pill{background:var(--chip);color:var(--chip-text);padding:6px 8px;border-radius:8px;font-size:.8rem}
-.small{font-size:.8rem;color:var(--muted)}
-#calendar{background:var(--surface);border:1px solid var(--stroke);border-radius:12px;box-shadow:0 10px 30px var(--shadow);padding:10px}
-"""
+USER_CACHE_TTL = 5.0  # segundos; limita a defasagem entre processos
+# só usuários que existem entram: o username vem do cliente nas rotas /api sem login, e guardar
+# os "não encontrado" deixaria cada nome aleatório crescer o dict sem limite
+_user_cache = {}      # username_ci -> (expira_em, linha (id, username, role))
+
+def _user_by_username(username):
+    # busca sem diferenciar maiúsculas; a linha traz o nome canônico em row.username
+    key = username.strip().lower()
+    now = time.monotonic()
+    hit = _user_cache.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    row = db.session.execute(
+        select(User.id, User.username, User.role).where(User.username_ci == key)
+    ).first()
+    if row is not None:
+        _user_cache[key] = (now + USER_CACHE_TTL, row)
+    return row
+
+_users_list_cache = None  # (expira_em, [linhas (id, username, role, host_id)])
+
+def _users_list():
+    # lista dos <select> de atribuição e da tabela de usuários do dashboard
+    global _users_list_cache
+    now = time.monotonic()
+    hit = _users_list_cache
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    rows = db.session.execute(
+        select(User.id, User.username, User.role, User.host_id).order_by(User.username.asc())
+    ).all()
+    _users_list_cache = (now + USER_CACHE_TTL, rows)
+    return rows
+
+def _invalidate_user_cache():
+    global _users_list_cache
+    _user_cache.clear()
+    _users_list_cache = None
+    _cal_cache.clear()  # o título dos eventos leva o username
+    _tasks_changed()    # ...e o ETag do calendário também
+
+# versão das tarefas em memória: sobe depois de cada commit que mexe em tasks
+# (COUNT + MAX(updated_at) sem WHERE era SCAN da tabela a cada /api/calendar_events).
+# Parte do relógio do boot para um ETag antigo não coincidir depois de reiniciar.
+_tasks_rev = time.time_ns()
+_tasks_rev_lock = threading.Lock()
+
+def _tasks_changed():
+    global _tasks_rev
+    with _tasks_rev_lock:
+        _tasks_rev += 1
 
-THEME_JS = """
-<script>
-(function(){
-  const root = document.documentElement;
-  const current = localStorage.getItem('theme') || 'light';
-  root.setAttribute('data-theme', current);
-  function labelFor(theme){ return theme==='dark' ? 'Light' : 'Black'; }
-  function iconFor(theme){ return theme==='dark' ? '☀️' : '🌙'; }
-  function updateBtn(btn){
-    const t = root.getAttribute('data-theme');
-    btn.querySelector('.icon').textContent = iconFor(t);
-    btn.querySelector('.label').textContent = labelFor(t);
-  }
-  window.applyThemeToggle = function(buttonId){
-    const btn = document.getElementById(buttonId);
-    if(!btn) return;
-    updateBtn(btn);
-    btn.addEventListener('click',()=>{
-      const next = root.getAttribute('data-theme')==='light' ? 'dark' : 'light';
-      root.setAttribute('data-theme', next);
-      localStorage.setItem('theme', next);
-      updateBtn(btn);
-    });
-  }
-})();
-</script>
-"""
+# =============================
+# HELPERS (FORMULÁRIOS)
+# =============================
+def _pos_int(s):
+    # ids vindos de form/query string: uma passada só; fora do INTEGER do SQLite vira None
+    try:
+        n = int(s)
+    except (TypeError, ValueError):
+        return None
+    return n if 0 < n < 2**63 else None
+
+def _parse_local_dt(s):
+    # formato fixo do <input type="datetime-local">: YYYY-MM-DDTHH:MM ou YYYY-MM-DDTHH:MM:SS;
+    # qualquer outro tamanho/sobra no fim é rejeitado (None), como no strptime original
+    n = len(s)
+    if n not in (16, 19) or s[4] != "-" or s[7] != "-" or s[10] != "T" or s[13] != ":" or (n == 19 and s[16] != ":"):
+        return None
+    try:
+        # forma já conferida acima: montagem direta por fatias, sem formato para interpretar
+        return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]),
+                                 int(s[17:19]) if n == 19 else 0)
+    except ValueError:
+        return None
+
+_URL_ID_SLOT = 987654321  # id-marcador: nunca aparece no resto da URL
+
+def _task_url_parts(endpoint):
+    # um url_for por request: em laços por tarefa o link sai de head + id + tail
+    head, _, tail = url_for(endpoint, task_id=_URL_ID_SLOT).rpartition(str(_URL_ID_SLOT))
+    return head, tail
 
 # =============================
-# LOGIN
+# HELPERS (CACHE HTTP)
 # =============================
-TPL_LOGIN = """<!DOCTYPE html>
-<html lang="pt-BR" data-theme="light"><head><meta charset="utf-8" />
-<meta name="viewport" content="width=device-width, initial-scale=1" />
-<title>Login • Painel de Tarefas</title>
-<style>{{ theme_css|safe }}</style>
-{{ theme_js|safe }}
-</head>
-<body>
-  <div class="container">
-    <div class="topbar">
-      <div class="title">Entrar no Painel</div>
-      <button id="toggleLogin" class="btn-theme"><span class="icon">🌙</span> <span class="label">Black</span></button>
-    </div>
-    <div class="card" style="max-width:420px;margin:20px auto;">
-      <div class="small" style="margin-bottom:8px;">Use seu usuário e senha</div>
-      {% if error %}<div class="pill" style="background:#ffd6d6;color:#b10000;">{{error}}</div>{% endif %}
-      <form method="post" style="margin-top:10px;">
-        <label>Usuário</label><input name="username" autocomplete="username" />
-        <label>Senha</label><input name="password" type="password" autocomplete="current-password" />
-        <div style="height:10px"></div>
-        <button class="btn" type="submit">Entrar</button>
-      </form>
-    </div>
-  </div>
-  <script>applyThemeToggle('toggleLogin');</script>
-</body></html>
-"""
+GZIP_MIN_SIZE = 1024  # abaixo disso o cabeçalho gzip não compensa
+
+def _json_if_changed(version, build, stream=False, raw=False):
+    # ETag fraca derivada da versão dos dados + URL; 304 sai antes de montar/serializar o JSON
+    # stream=True: build() é um gerador de pedaços de bytes do JSON, enviados conforme saem do banco
+    # raw=True: build() devolve o JSON já serializado (bytes); sem Content-Encoding, o gzip fica com o after_request
+    etag = hashlib.blake2s(repr((request.full_path, version)).encode(), digest_size=12).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    elif stream:
+        body = stream_with_context(build())
+        resp = Response(mimetype="application/json")
+        if request.accept_encodings["gzip"]:
+            # mesmo gzip contínuo do SSE: cada lote sai comprimido sem esperar o resto
+            body = _gzip_stream(body)
+            resp.headers["Content-Encoding"] = "gzip"
+        resp.vary.add("Accept-Encoding")
+        resp.response = body
+    elif raw:
+        resp = Response(build(), mimetype="application/json")
+    else:
+        resp = jsonify(build())
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"  # sempre revalida, mas aceita o 304
+    return resp
+
+# muda a cada start do processo: cobre template editado e ?v= dos estáticos (ambos fixos por processo)
+_BOOT_ID = time.time_ns()
+
+def _html_if_changed(key, render):
+    # páginas por usuário: 304 sem renderizar enquanto o que entra no template for o mesmo
+    etag = hashlib.blake2s(repr((_BOOT_ID, request.path, key)).encode(), digest_size=12).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(render(), mimetype="text/html")
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.vary.add("Cookie")
+    return resp
+
+def _gzip_bytes(data):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return z.compress(data) + z.flush()
+
+_GZIP_MIMETYPES = frozenset(("application/json", "text/html"))
+
+@app.after_request
+def _gzip_body(resp):
+    # JSON da API e as páginas HTML (dashboard, calendário...); estáticos e streams ficam de fora
+    if (resp.mimetype not in _GZIP_MIMETYPES or resp.status_code != 200
+            or resp.direct_passthrough or resp.is_streamed
+            or "Content-Encoding" in resp.headers
+            or not request.accept_encodings["gzip"]):  # respeita q: "gzip;q=0" recusa
+        return resp
+    data = resp.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return resp
+    resp.set_data(_gzip_bytes(data))
+    resp.headers["Content-Encoding"] = "gzip"
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+# =============================
+# TEMA BÁSICO (static/theme.css + static/theme.js)
+# =============================
+# os arquivos estáticos são servidos com cache longo; ?v=<mtime> invalida quando mudam
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 31536000
+_static_versions = {}
+
+@app.url_defaults
+def _static_version(endpoint, values):
+    if endpoint != "static" or "filename" not in values:
+        return
+    fname = values["filename"]
+    v = _static_versions.get(fname)
+    if v is None:
+        try:
+            v = int(os.stat(os.path.join(app.static_folder, fname)).st_mtime)
+        except OSError:
+            return
+        _static_versions[fname] = v
+    values["v"] = v
+
+# FullCalendar servido localmente (opcional): com index.global.min.js e pt-br.global.min.js em
+# static/vendor/fullcalendar/, o calendário sai do CDN e ganha o ?v= + cache imutável acima
+_FC_LOCAL = os.path.isfile(os.path.join(app.static_folder, "vendor", "fullcalendar", "index.global.min.js"))
+
+@app.after_request
+def _static_immutable(resp):
+    # URL versionada (?v=<mtime>) nunca muda de conteúdo: o browser nem revalida
+    if request.endpoint == "static" and "v" in request.args and resp.status_code == 200:
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+    return resp
 
+# =============================
+# LOGIN
+# =============================
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         usr = request.form.get("username", "").strip()
         pwd = request.form.get("password", "").strip()
-        search_username = usr.strip()
-        if search_username.lower() != 'admin':
-            search_username = search_username.capitalize()
-        u = User.query.filter_by(username=search_username).first()
-        if u and u.check_password(pwd):
-            session["user_id"] = u.id
+        row = db.session.execute(
+            select(User.id, User.username, User.password_hash).where(User.username_ci == usr.lower())
+        ).first()
+        if row and check_password_hash(row.password_hash, pwd):
+            # migração preguiçosa: hashes com custo abaixo do alvo (ex.: pbkdf2 de 60k iterações)
+            if password_needs_rehash(row.password_hash):
+                db.session.execute(update(User).where(User.id == row.id).values(password_hash=hash_password(pwd)))
+                db.session.commit()
+            session["user_id"] = row.id
+            session["username"] = row.username
             return redirect(url_for("calendar_view"))
-        return render_template_string(TPL_LOGIN, error="Login incorreto", theme_css=THEME_CSS, theme_js=THEME_JS)
-    return render_template_string(TPL_LOGIN, error=None, theme_css=THEME_CSS, theme_js=THEME_JS)
+        return render_template("login.html", error="Login incorreto")
+    return render_template("login.html", error=None)
 
 @app.route("/logout")
 def logout():
@@ -309,8 +770,9 @@ TPL_DASHBOARD = """<!DOCTYPE html>
 <html lang="pt-BR"><head><meta charset="utf-8" />
 <meta name="viewport" content="width=device-width, initial-scale=1" />
 <title>Painel • Tarefas</title>
-<style>{{ theme_css|safe }}</style>
-{{ theme_js|safe }}
+<script>document.documentElement.dataset.theme=localStorage.getItem('theme')||'light'</script>
+<link rel="stylesheet" href="{{ url_for('static', filename='theme.css') }}">
+<script defer src="{{ url_for('static', filename='theme.js') }}"></script>
 </head>
 <body>
   <div class="container">
@@ -379,18 +841,18 @@ TPL_DASHBOARD = """<!DOCTYPE html>
               <tr>
                 <th>ID</th><th>Título</th><th>Descrição</th><th>Atribuído</th><th>Status</th><th>Vencimento</th><th>Criada</th><th></th>
               </tr>
-              {% for t in tasks %}
+              {% for t in tasks.items %}
               <tr>
                 <td>#{{t.id}}</td>
                 <td>{{t.title}}</td>
                 <td style="white-space:pre-wrap;">{{t.description or '-'}}</td>
-                <td>{{t.assigned_to.username if t.assigned_to else '-'}}</td>
+                <td>{{t.username or '-'}}</td>
                 <td><span class="pill">{{t.status}}</span></td>
                 <td class="small">{{t.due_date or '-'}}</td>
                 <td class="small">{{t.created_at}}</td>
                 <td>
-                  <a class="btn" href="{{url_for('edit_task_form', task_id=t.id)}}">Editar</a>
-                  <form method="post" action="{{url_for('delete_task', task_id=t.id)}}" style="display:inline" onsubmit="return confirm('Excluir tarefa #{{t.id}}?');">
+                  <a class="btn" href="{{edit_url[0]}}{{t.id}}{{edit_url[1]}}">Editar</a>
+                  <form method="post" action="{{delete_url[0]}}{{t.id}}{{delete_url[1]}}" style="display:inline" onsubmit="return confirm('Excluir tarefa #{{t.id}}?');">
                     <button class="btn" style="background:transparent;color:var(--text);border:1px solid var(--stroke)">Excluir</button>
                   </form>
                 </td>
@@ -398,6 +860,13 @@ TPL_DASHBOARD = """<!DOCTYPE html>
               {% endfor %}
             </table>
           </div>
+          {% if tasks.pages > 1 %}
+          <div class="small" style="display:flex;gap:10px;align-items:center;margin-top:12px;">
+            {% if tasks.has_prev %}<a class="btn" href="{{url_for('dashboard', page=tasks.prev_num)}}">‹ Anterior</a>{% endif %}
+            <span>Página {{tasks.page}} de {{tasks.pages}} ({{tasks.total}} tarefas)</span>
+            {% if tasks.has_next %}<a class="btn" href="{{url_for('dashboard', page=tasks.next_num)}}">Próxima ›</a>{% endif %}
+          </div>
+          {% endif %}
         </div>
 
         <div class="card" style="margin-top:16px;">
@@ -414,9 +883,11 @@ TPL_DASHBOARD = """<!DOCTYPE html>
       </section>
     </main>
   </div>
-  <script>applyThemeToggle('toggleDash');</script>
+  <script>document.addEventListener('DOMContentLoaded',()=>applyThemeToggle('toggleDash'));</script>
 </body></html>
 """
+_TPL_DASHBOARD = app.jinja_env.from_string(TPL_DASHBOARD)
+DASHBOARD_PER_PAGE = 50
 
 @app.route("/dashboard")
 def dashboard():
@@ -424,15 +895,25 @@ def dashboard():
         return redirect(url_for("login"))
     if not is_admin():
         return redirect(url_for("calendar_view"))
-    tasks = Task.query.order_by(Task.created_at.desc()).all()
-    users_list = User.query.order_by(User.username.asc()).all()
-    return render_template_string(
-        TPL_DASHBOARD,
+    # LIMIT/OFFSET: só a página pedida sai do banco e vai para o HTML;
+    # só as colunas da tabela, com o username no mesmo SELECT (linhas, não objetos ORM)
+    page = request.args.get("page", 1, type=int)
+    tasks = (
+        db.session.query(
+            Task.id, Task.title, Task.description, Task.status,
+            Task.due_date, Task.created_at, User.username,
+        )
+        .outerjoin(User, Task.assigned_to_id == User.id)
+        .order_by(Task.created_at.desc())
+        .paginate(page=page, per_page=DASHBOARD_PER_PAGE, error_out=False)
+    )
+    users_list = _users_list()
+    return _TPL_DASHBOARD.render(
         user=current_user(),
         tasks=tasks,
         users=users_list,
-        theme_css=THEME_CSS,
-        theme_js=THEME_JS
+        edit_url=_task_url_parts("edit_task_form"),
+        delete_url=_task_url_parts("delete_task"),
     )
 
 # cria tarefa (Painel/Calendário)
@@ -447,17 +928,12 @@ def create_task():
     due_date_raw = request.form.get("due_date", "").strip()
 
     # admin pode escolher; usuário comum é atribuído a si mesmo
-    assigned_to_id = request.form.get("assigned_to_id", "").strip() if is_admin() else str(u.id)
+    ass_id = _pos_int(request.form.get("assigned_to_id")) if is_admin() else u.id
 
     if not title:
         return "Título obrigatório", 400
 
-    due_dt = None
-    if due_date_raw:
-        try:
-            due_dt = datetime.datetime.strptime(due_date_raw, "%Y-%m-%dT%H:%M")
-        except ValueError:
-            due_dt = None
+    due_dt = _parse_local_dt(due_date_raw)
 
     t = Task(
         title=title,
@@ -467,23 +943,23 @@ def create_task():
         due_date=due_dt,
     )
 
-    if assigned_to_id and assigned_to_id.isdigit():
-        ass = db.session.get(User, int(assigned_to_id))
+    if ass_id:
+        ass = db.session.get(User, ass_id)
         if ass:
             t.assigned_to = ass
 
     db.session.add(t)
+    db.session.flush()  # gera o id sem fechar a transação
+    target = t.assigned_to.username if t.assigned_to else None
+    # sem ninguém ouvindo, nem monta o evento
+    ev = _task_event("created", t) if target and sse_wants_events(target) else None
     db.session.commit()
+    _tasks_changed()
 
-    if t.assigned_to:
-        sse_publish(t.assigned_to.username, {
-            "type": "created",
-            "task": {
-                "id": t.id, "title": t.title, "description": t.description or "",
-                "status": t.status, "due_date": t.due_date.isoformat() if t.due_date else None
-            }
-        })
-    sse_publish("admin", {"type": "changed"})
+    # o pump do SSE distribui em background; aqui é só serializar e enfileirar
+    if ev is not None:
+        sse_publish(target, ev)
+    sse_publish("admin", _EV_CHANGED)
 
     # Se veio do calendário (modal com fetch), redirecionar de volta ao calendário
     # (o frontend trata com fetch e refetchEvents; manter redirect funciona para submit tradicional)
@@ -496,11 +972,11 @@ def emit_alert():
         abort(403)
     title = request.form.get("title", "").strip()
     description = request.form.get("description", "").strip()
-    assigned_to_id = request.form.get("assigned_to_id", "").strip()
-    if not (title and assigned_to_id.isdigit()):
+    ass_id = _pos_int(request.form.get("assigned_to_id"))
+    if not (title and ass_id):
         return "Dados inválidos", 400
 
-    ass = db.session.get(User, int(assigned_to_id))
+    ass = db.session.get(User, ass_id)
     if not ass:
         return "Usuário inválido", 400
 
@@ -514,36 +990,26 @@ def emit_alert():
         due_date=now
     )
     db.session.add(t)
+    db.session.flush()
+    target = ass.username
+    ev = _task_event("alert", t) if sse_wants_events(target) else None
     db.session.commit()
+    _tasks_changed()
 
-    sse_publish(ass.username, {
-        "type": "alert",
-        "task": {
-            "id": t.id, "title": t.title, "description": t.description or "",
-            "status": t.status, "due_date": t.due_date.isoformat() if t.due_date else None
-        }
-    })
-    sse_publish("admin", {"type": "changed"})
+    if ev is not None:
+        sse_publish(target, ev)
+    sse_publish("admin", _EV_CHANGED)
 
     return redirect(url_for("dashboard"))
 
 # editar
-@app.route("/task/<int:task_id>/edit", methods=["GET"])
-def edit_task_form(task_id):
-    if not require_login():
-        abort(403)
-    t = db.session.get(Task, task_id)
-    if not t:
-        abort(404)
-    users_list = User.query.order_by(User.username.asc()).all() if is_admin() else []
-    task_logs = TaskLog.query.filter_by(task_id=task_id).order_by(TaskLog.executed_at.desc()).all()
-    
-    TPL_EDIT = """<!DOCTYPE html>
+TPL_EDIT = """<!DOCTYPE html>
 <html lang="pt-BR"><head><meta charset="utf-8" />
 <meta name="viewport" content="width=device-width, initial-scale=1" />
 <title>Editar Tarefa</title>
-<style>{{ theme_css|safe }}</style>
-{{ theme_js|safe }}
+<script>document.documentElement.dataset.theme=localStorage.getItem('theme')||'light'</script>
+<link rel="stylesheet" href="{{ url_for('static', filename='theme.css') }}">
+<script defer src="{{ url_for('static', filename='theme.js') }}"></script>
 </head>
 <body>
   <div class="container">
@@ -607,17 +1073,26 @@ def edit_task_form(task_id):
       </div>
     </div>
   </div>
-  <script>applyThemeToggle('toggleEdit');</script>
+  <script>document.addEventListener('DOMContentLoaded',()=>applyThemeToggle('toggleEdit'));</script>
 </body></html>
 """
-    return render_template_string(
-        TPL_EDIT,
+_TPL_EDIT = app.jinja_env.from_string(TPL_EDIT)
+
+@app.route("/task/<int:task_id>/edit", methods=["GET"])
+def edit_task_form(task_id):
+    if not require_login():
+        abort(403)
+    # tarefa + responsável + histórico num único SELECT (poucos logs por tarefa)
+    t = db.session.get(Task, task_id, options=[joinedload(Task.assigned_to), joinedload(Task.logs)])
+    if not t:
+        abort(404)
+    admin = is_admin()
+    users_list = _users_list() if admin else []
+    return _TPL_EDIT.render(
         task=t,
         users=users_list,
-        is_admin=is_admin(),
-        task_logs=task_logs,
-        theme_css=THEME_CSS,
-        theme_js=THEME_JS
+        is_admin=admin,
+        task_logs=t.logs,
     )
 
 @app.route("/task/<int:task_id>/edit", methods=["POST"])
@@ -640,34 +1115,22 @@ def edit_task(task_id):
     t.description = description or None
     t.status = status or "pendente"
 
-    if due_date_raw:
-        try:
-            t.due_date = datetime.datetime.strptime(due_date_raw, "%Y-%m-%dT%H:%M")
-        except ValueError:
-            t.due_date = None
-    else:
-        t.due_date = None
+    t.due_date = _parse_local_dt(due_date_raw)
 
     if is_admin():
         assigned_to_id = request.form.get("assigned_to_id", "").strip()
         if assigned_to_id:
-            if assigned_to_id.isdigit():
-                ass = db.session.get(User, int(assigned_to_id))
-                t.assigned_to = ass
-            else:
-                t.assigned_to = None
+            ass_id = _pos_int(assigned_to_id)
+            t.assigned_to = db.session.get(User, ass_id) if ass_id else None
 
+    target = t.assigned_to.username if t.assigned_to else None
+    ev = _task_event("updated", t) if target and sse_wants_events(target) else None
     db.session.commit()
+    _tasks_changed()
 
-    if t.assigned_to:
-        sse_publish(t.assigned_to.username, {
-            "type": "updated",
-            "task": {
-                "id": t.id, "title": t.title, "description": t.description or "",
-                "status": t.status, "due_date": t.due_date.isoformat() if t.due_date else None
-            }
-        })
-    sse_publish("admin", {"type": "changed"})
+    if ev is not None:
+        sse_publish(target, ev)
+    sse_publish("admin", _EV_CHANGED)
 
     return redirect(url_for("calendar_view"))
 
@@ -679,29 +1142,16 @@ def add_task_log(task_id):
     if not require_login():
         abort(403)
     u = current_user()
-    t = db.session.get(Task, task_id)
+    t = db.session.get(Task, task_id, options=[joinedload(Task.assigned_to)])
     message = request.form.get("message", "").strip()
 
     if not (t and message):
         return "Dados inválidos", 400
-    
-    lg = TaskLog(task_id=t.id, host_id=u.username, status="observation_web", message=message)
-    db.session.add(lg)
-    db.session.commit()
-    
-    target_username = t.assigned_to.username if t.assigned_to else "admin"
-    sse_publish(target_username, {"type": "new_observation", "task_id": t.id, "message": message, "user": u.username})
-    if target_username != "admin":
-        sse_publish("admin", {"type": "new_observation", "task_id": t.id, "message": message, "user": u.username})
 
-    payload = {
-        "id": t.id,
-        "title": f"[OBS] Nova interação na tarefa #{t.id}",
-        "description": (message or "")[:280],
-        "status": t.status,
-        "due_date": t.due_date.isoformat() if t.due_date else None
-    }
-    sse_publish(target_username, {"type": "alert", "task": payload})
+    events = _observation_events(t, u.username, message)
+    db.session.execute(_STMT_INSERT_LOG, {"task_id": t.id, "host_id": u.username, "status": "observation_web", "message": message})
+    db.session.commit()
+    broadcast_observation(*events)
 
     return redirect(url_for("edit_task_form", task_id=task_id))
 
@@ -709,141 +1159,106 @@ def add_task_log(task_id):
 @app.route("/api/task_logs")
 def api_task_logs():
     username = request.args.get("username", "").strip()
-    task_id = request.args.get("task_id", "").strip()
-    if not (username and task_id.isdigit()):
+    task_id = _pos_int(request.args.get("task_id"))
+    if not (username and task_id):
         return jsonify({"error": "bad_request"}), 400
 
-    search_username = username if username.lower() == "admin" else username.capitalize()
-    user = User.query.filter_by(username=search_username).first()
+    user = _user_by_username(username)
     if not user:
         return jsonify({"error": "user_not_found"}), 404
 
-    t = db.session.get(Task, int(task_id))
+    t = db.session.get(Task, task_id)
     if not t:
         return jsonify({"error": "task_not_found"}), 404
 
     if user.role != "admin" and (t.assigned_to_id != user.id):
         return jsonify({"error": "forbidden"}), 403
 
-    logs = TaskLog.query.filter_by(task_id=t.id).order_by(TaskLog.executed_at.asc()).all()
-    return jsonify([{
-        "id": lg.id,
-        "task_id": lg.task_id,
-        "by": lg.host_id,
-        "status": lg.status,
-        "message": lg.message or "",
-        "at": lg.executed_at.isoformat()
-    } for lg in logs])
+    def build():
+        logs = db.session.execute(_STMT_TASK_LOGS, {"tid": t.id}).all()
+        return [{
+            "id": lg.id,
+            "task_id": lg.task_id,
+            "by": lg.host_id,
+            "status": lg.status,
+            "message": lg.message or "",
+            "at": lg.executed_at.isoformat()
+        } for lg in logs]
+
+    version = tuple(db.session.execute(_STMT_LOGS_VERSION, {"tid": t.id}).one())
+    return _json_if_changed(version, build)
 
 @app.route("/task/<int:task_id>/delete", methods=["POST"])
 def delete_task(task_id):
     if not require_login() or not is_admin():
         abort(403)
-    t = db.session.get(Task, task_id)
-    if not t:
+    # DELETE direto, sem SELECT antes; os logs da tarefa saem na mesma transação
+    deleted = db.session.execute(delete(Task).where(Task.id == task_id)).rowcount
+    if not deleted:
+        db.session.rollback()
         abort(404)
-    db.session.delete(t)
+    db.session.execute(delete(TaskLog).where(TaskLog.task_id == task_id))
     db.session.commit()
-    sse_publish("admin", {"type": "changed"})
+    _tasks_changed()
+    sse_publish("admin", _EV_CHANGED)
     return redirect(url_for("dashboard"))
 
 # =============================
 # USER LISTA / CONCLUI
 # =============================
+# rótulos de exibição: filtro registrado uma vez no ambiente Jinja, nada por request no contexto
+STATUS_LABELS = {"pendente": "Pendente", "em_andamento": "Em andamento", "concluida": "Concluída"}
+
+@app.template_filter("status_label")
+def _status_label(status):
+    return STATUS_LABELS.get(status, status)
+
+USER_TASKS_PER_PAGE = 100
+
 @app.route("/user_tasks")
 def user_tasks():
     if not require_login():
         return redirect(url_for("login"))
     u = current_user()
-    tasks = Task.query.filter(
-        Task.active.is_(True),
-        Task.assigned_to_id == u.id
-    ).order_by(Task.created_at.desc()).all()
-
-    def format_status(status):
-        if status == 'pendente':
-            return 'Pendente'
-        elif status == 'em_andamento':
-            return 'Em andamento'
-        elif status == 'concluida':
-            return 'Concluída'
-        return status
-
-    TPL_USER = """<!DOCTYPE html>
-<html lang="pt-BR"><head><meta charset="utf-8" />
-<meta name="viewport" content="width=device-width, initial-scale=1" />
-<title>Minhas Tarefas</title>
-<style>{{ theme_css|safe }}</style>
-{{ theme_js|safe }}
-</head>
-<body>
-  <div class="container">
-    <div class="topbar">
-      <div>
-        <div class="title">Minhas Tarefas</div>
-        <div class="small">Marque como concluída quando terminar.</div>
-      </div>
-      <div class="top-right">
-        <div>Usuário: <b>{{user.username}}</b> ({{user.role}})</div>
-        <div class="top-links"><a href="{{url_for('logout')}}">Sair</a></div>
-        <button id="toggleUser" class="btn-theme"><span class="icon">🌙</span> <span class="label">Black</span></button>
-      </div>
-    </div>
-
-    <div class="card" style="max-width:920px;margin:16px auto;">
-      {% if tasks %}
-        {% for t in tasks %}
-          <div class="card" style="margin-bottom:12px;background:var(--surface-2)">
-            <div style="display:flex;justify-content:space-between;gap:12px;align-items:center;">
-              <div style="font-weight:700">#{{t.id}} · {{t.title}} <span class="small">({{format_status(t.status)}})</span></div>
-              {% if t.status != 'concluida' %}
-              <form method="post" action="{{url_for('mark_task_complete')}}">
-                <input type="hidden" name="task_id" value="{{t.id}}" />
-                <button class="btn" type="submit">✔ Concluir</button>
-              </form>
-              {% else %}
-              <div class="small">Concluída</div>
-              {% endif %}
-            </div>
-            <div class="small" style="white-space:pre-wrap;margin-top:6px;">{{t.description or '-'}}</div>
-            <div class="small" style="margin-top:6px;">Venc: {{t.due_date or '-'}}</div>
-          </div>
-        {% endfor %}
-      {% else %}
-        <div style="text-align:center;color:var(--muted);">Nenhuma tarefa pendente 👌</div>
-      {% endif %}
-    </div>
-  </div>
-  <script>applyThemeToggle('toggleUser');</script>
-</body></html>
-"""
-    return render_template_string(
-        TPL_USER, user=u, tasks=tasks, format_status=format_status,
-        theme_css=THEME_CSS, theme_js=THEME_JS
-    )
+    params = {"uid": u.id, "lim": USER_TASKS_PER_PAGE + 1}  # +1: só para saber se há mais
+    stmt = _STMT_USER_TASKS
+    before = _pos_int(request.args.get("before"))
+    if before:
+        c = db.session.scalar(select(Task.created_at).where(Task.id == before))
+        if c is not None:
+            stmt = _STMT_USER_TASKS_BEFORE
+            params.update(c=c, before=before)
+    tasks = db.session.scalars(stmt, params).all()
+    next_before = None
+    if len(tasks) > USER_TASKS_PER_PAGE:
+        tasks = tasks[:USER_TASKS_PER_PAGE]
+        next_before = tasks[-1].id
+    return render_template("user_tasks.html", user=u, tasks=tasks, next_before=next_before)
 
 @app.route("/task/complete", methods=["POST"])
 def mark_task_complete():
     if not require_login():
         return redirect(url_for("login"))
     u = current_user()
-    task_id_raw = request.form.get("task_id", "").strip()
-    if not task_id_raw.isdigit():
+    task_id = _pos_int(request.form.get("task_id"))
+    if not task_id:
         return "task_id inválido", 400
-    t = db.session.get(Task, int(task_id_raw))
-    if not t:
-        return "Tarefa não encontrada", 404
-    if t.assigned_to_id != u.id and not is_admin():
+    # UPDATE atômico: o WHERE já faz a checagem de dono, sem carregar a tarefa
+    stmt = update(Task).where(Task.id == task_id).values(status="concluida")
+    if not is_admin():
+        stmt = stmt.where(Task.assigned_to_id == u.id)
+    if db.session.execute(stmt).rowcount == 0:
+        # caminho raro: só aqui vale a consulta para separar 404 de 403
+        db.session.rollback()
+        if db.session.get(Task, task_id) is None:
+            return "Tarefa não encontrada", 404
         return "Não autorizado", 403
-
-    t.status = "concluida"
+    db.session.execute(_STMT_INSERT_LOG, {"task_id": task_id, "host_id": u.username, "status": "done_manual", "message": "Concluída via painel"})
     db.session.commit()
+    _tasks_changed()
 
-    lg = TaskLog(task_id=t.id, host_id=u.username, status="done_manual", message="Concluída via painel")
-    db.session.add(lg); db.session.commit()
-
-    sse_publish(u.username, {"type": "completed", "task": {"id": t.id}})
-    sse_publish("admin", {"type": "changed"})
+    sse_publish(u.username, {"type": "completed", "task": {"id": task_id}})
+    sse_publish("admin", _EV_CHANGED)
 
     return redirect(url_for("user_tasks"))
 
@@ -856,23 +1271,33 @@ def api_notify_tasks():
     if not username:
         return jsonify({"error": "username ausente"}), 400
 
-    user = User.query.filter_by(username=username).first()
+    user = _user_by_username(username)
     if not user:
         return jsonify([])
 
-    tasks = Task.query.filter(
-        Task.active.is_(True),
-        Task.assigned_to_id == user.id
-    ).order_by(Task.created_at.desc()).all()
-
-    return jsonify([{
-        "id": t.id,
-        "title": t.title,
-        "description": t.description or "",
-        "status": t.status,
-        "created_at": t.created_at.isoformat() if t.created_at else "",
-        "due_date": t.due_date.isoformat() if t.due_date else None
-    } for t in tasks])
+    def build():
+        # só as colunas usadas: tuplas Core, sem hidratar objetos ORM
+        # yield_per: o array sai em pedaços de 500 linhas, sem a lista inteira em memória
+        result = db.session.execute(
+            _STMT_NOTIFY_TASKS.execution_options(yield_per=500), {"uid": user.id}
+        )
+        sep = b"["
+        for part in result.partitions():
+            # datetimes vão crus: o orjson já emite ISO 8601, igual ao isoformat()
+            yield sep + b",".join(orjson.dumps({
+                "id": r.id,
+                "title": r.title,
+                "description": r.description or "",
+                "status": r.status,
+                "created_at": r.created_at or "",
+                "due_date": r.due_date
+            }) for r in part)
+            sep = b","
+        yield b"]" if sep == b"," else b"[]"
+
+    # versão só das tarefas do usuário: mudanças nas dos outros não invalidam o ETag dele
+    version = tuple(db.session.execute(_STMT_USER_TASKS_VERSION, {"uid": user.id}).one())
+    return _json_if_changed((user.id, version), build, stream=True)
 
 @app.route("/api/mark_complete", methods=["POST"])
 def api_mark_complete():
@@ -882,29 +1307,31 @@ def api_mark_complete():
         return jsonify({"error": "forbidden"}), 403
 
     username = request.form.get("username", "").strip()
-    task_id = request.form.get("task_id", "").strip()
+    task_id = _pos_int(request.form.get("task_id"))
 
-    if not (username and task_id.isdigit()):
+    if not (username and task_id):
         return jsonify({"error": "bad_request"}), 400
 
-    user = User.query.filter_by(username=username).first()
+    user = _user_by_username(username)
     if not user:
         return jsonify({"error": "user_not_found"}), 404
 
-    t = Task.query.filter_by(id=int(task_id), assigned_to_id=user.id).first()
-    if not t:
+    # UPDATE já filtrado pelo dono: nenhum SELECT da tarefa (o usuário vem do cache)
+    updated = db.session.execute(
+        update(Task).where(Task.id == task_id, Task.assigned_to_id == user.id).values(status="concluida")
+    ).rowcount
+    if not updated:
+        db.session.rollback()
         return jsonify({"error": "task_not_found"}), 404
 
-    t.status = "concluida"
+    db.session.execute(_STMT_INSERT_LOG, {"task_id": task_id, "host_id": user.username, "status": "done_api", "message": "Concluída via API pública"})
     db.session.commit()
+    _tasks_changed()
 
-    lg = TaskLog(task_id=t.id, host_id=username, status="done_api", message="Concluída via API pública")
-    db.session.add(lg); db.session.commit()
+    sse_publish(user.username, {"type": "completed", "task": {"id": task_id}})
+    sse_publish("admin", _EV_CHANGED)
 
-    sse_publish(username, {"type": "completed", "task": {"id": t.id}})
-    sse_publish("admin", {"type": "changed"})
-
-    return jsonify({"ok": True, "task_id": t.id})
+    return jsonify({"ok": True, "task_id": task_id})
 
 # API: Adiciona uma observação/log à tarefa (via Extensão)
 @app.route("/api/add_observation", methods=["POST"])
@@ -915,72 +1342,99 @@ def api_add_observation():
         return jsonify({"error": "forbidden"}), 403
 
     username = request.form.get("username", "").strip()
-    task_id = request.form.get("task_id", "").strip()
+    task_id = _pos_int(request.form.get("task_id"))
     message = request.form.get("message", "").strip()
 
-    if not (username and task_id.isdigit() and message):
+    if not (username and task_id and message):
         return jsonify({"error": "bad_request", "details": "username, task_id ou message ausente"}), 400
 
-    search_username = username.strip()
-    if search_username.lower() != 'admin':
-        search_username = search_username.capitalize()
-        
-    user = User.query.filter_by(username=search_username).first()
+    user = _user_by_username(username)
     if not user:
         return jsonify({"error": "user_not_found"}), 404
 
-    t = db.session.get(Task, int(task_id))
+    t = db.session.get(Task, task_id, options=[joinedload(Task.assigned_to)])
     if not t:
         return jsonify({"error": "task_not_found"}), 404
-        
-    lg = TaskLog(task_id=t.id, host_id=user.username, status="observation", message=message)
-    db.session.add(lg)
-    db.session.commit()
-    
-    target_username = t.assigned_to.username if t.assigned_to else "admin"
-    sse_publish(target_username, {"type": "new_observation", "task_id": t.id, "message": message, "user": user.username})
-    if target_username != "admin":
-        sse_publish("admin", {"type": "new_observation", "task_id": t.id, "message": message, "user": user.username})
 
-    payload = {
-        "id": t.id,
-        "title": f"[OBS] Nova interação na tarefa #{t.id}",
-        "description": (message or "")[:280],
-        "status": t.status,
-        "due_date": t.due_date.isoformat() if t.due_date else None
-    }
-    sse_publish(target_username, {"type": "alert", "task": payload})
+    events = _observation_events(t, user.username, message)
+    db.session.execute(_STMT_INSERT_LOG, {"task_id": t.id, "host_id": user.username, "status": "observation", "message": message})
+    db.session.commit()
+    broadcast_observation(*events)
 
-    return jsonify({"ok": True, "task_id": t.id})
+    return jsonify({"ok": True, "task_id": task_id})
 
 # =============================
 # CALENDÁRIO
 # =============================
+_ISO_Z_NATIVE = sys.version_info >= (3, 11)  # fromisoformat aceita "Z" e mais formatos ISO
+_fromiso = datetime.datetime.fromisoformat      # método já resolvido: sem lookup de atributo por chamada
+# status -> classNames do FullCalendar (cor do dot em theme.css); status desconhecido cai em "pendente"
+_CAL_CLASSES = {"em_andamento": ("em_andamento",), "concluida": ("concluida",)}
+_CAL_CLASS_DEFAULT = ("pendente",)
+CALENDAR_MAX_EVENTS = 2000  # teto por janela: um intervalo patológico não materializa a tabela toda
+CALENDAR_CACHE_TTL = 30.0   # segundos
+CALENDAR_CACHE_MAX = 256    # janelas distintas guardadas; passou disso, recomeça do zero
+# (URL, versão das tarefas) -> (expira_em, corpo JSON, corpo gzip ou None, truncado): a chave já muda a cada alteração,
+# então o refetch de todos os calendários após um evento SSE cai aqui em vez de ir ao banco
+_cal_cache = {}
+
+# poucos limites distintos (um por mês/semana visível), repetidos a cada refetch de todos os usuários;
+# função pura e datetime é imutável: seguro memoizar
+@functools.lru_cache(maxsize=512)
 def _parse_iso_flex(s: str):
     if not s:
         return None
     s = s.strip()
+    if not _ISO_Z_NATIVE and s[-1:] == "Z":
+        s = s[:-1] + "+00:00"
     try:
-        if s.endswith("Z"):
-            s = s.replace("Z", "+00:00")
-        return datetime.datetime.fromisoformat(s)
-    except Exception:
-        try:
-            if "T" in s:
-                s = s.split("T", 1)[0]
-            return datetime.datetime.strptime(s, "%Y-%m-%d")
-        except Exception:
-            return None
+        # caminho comum (FullCalendar): resolvido em C, sem unwinding de exceção
+        return _fromiso(s)
+    except ValueError:
+        pass
+    # fallback: aproveita só a data "YYYY-MM-DD" do começo (meia-noite), também resolvida em C
+    if len(s) < 10 or s[4] != "-" or s[7] != "-":
+        return None
+    try:
+        return _fromiso(s[:10])
+    except ValueError:
+        return None
 
 @app.route("/api/calendar_events")
 def api_calendar_events():
-    q = Task.query.filter(Task.active.is_(True))
+    # cache antes de qualquer trabalho: um hit não consulta usuário nem banco, só lê a versão em memória
+    version = _tasks_rev
+    key = (request.full_path, version)
+    now = time.monotonic()
+    hit = _cal_cache.get(key)
+    if hit is not None and hit[0] > now:
+        _, body, gz, cut = hit
+        use_gz = gz is not None and request.accept_encodings["gzip"] > 0
+        resp = _json_if_changed(version, lambda: gz if use_gz else body, raw=True)
+        if resp.status_code == 200:
+            if use_gz:
+                resp.headers["Content-Encoding"] = "gzip"  # já comprimido: o after_request pula
+            resp.vary.add("Accept-Encoding")
+            if cut:
+                resp.headers["X-Calendar-Truncated"] = str(CALENDAR_MAX_EVENTS)
+        return resp
+
+    # projeção de colunas + username via outer join: sem objetos ORM nem 2ª query;
+    # o título "Tarefa (usuário)" já sai montado do SQLite
+    q = (
+        select(
+            Task.id, Task.status, Task.due_date,
+            (Task.title + " (" + func.coalesce(User.username, "-") + ")").label("cal_title"),
+        )
+        .outerjoin(User, Task.assigned_to_id == User.id)
+        .where(Task.active.is_(True), Task.due_date.isnot(None))
+    )
 
     assigned_name = request.args.get("assigned_to", "").strip()
     if assigned_name:
-        u = User.query.filter_by(username=assigned_name).first()
+        u = _user_by_username(assigned_name)
         if u:
-            q = q.filter(Task.assigned_to_id == u.id)
+            q = q.where(Task.assigned_to_id == u.id)
         else:
             return jsonify([])
 
@@ -989,26 +1443,58 @@ def api_calendar_events():
 
     s_dt = _parse_iso_flex(start)
     e_dt = _parse_iso_flex(end)
+    if (start and s_dt is None) or (end and e_dt is None):
+        # limite ilegível: sem isso a consulta cairia na tabela inteira
+        app.logger.warning("calendar_events: intervalo inválido start=%r end=%r", start, end)
+        return jsonify({"error": "start/end inválido"}), 400
 
     if s_dt and e_dt:
-        q = q.filter(Task.due_date.isnot(None), Task.due_date >= s_dt, Task.due_date <= e_dt)
-    else:
-        q = q.filter(Task.due_date.isnot(None))
-
-    tasks = q.order_by(Task.due_date.asc().nulls_last()).all()
-
-    events = []
-    for t in tasks:
-        if not t.due_date:
-            continue
-        events.append({
-            "id": t.id,
-            "title": f"{t.title} ({t.assigned_to.username if t.assigned_to else '-'})",
-            "start": t.due_date.strftime("%Y-%m-%dT%H:%M:%S"),
-            "url": url_for("edit_task_form", task_id=t.id),
-            "status": t.status,
-        })
-    return jsonify(events)
+        q = q.where(Task.due_date >= s_dt, Task.due_date <= e_dt)
+
+    # due_date IS NOT NULL já está no WHERE: nulls_last é desnecessário
+    q = q.order_by(Task.due_date.asc())
+    truncated = False  # definido abaixo, antes do gerador rodar
+
+    url_head, url_tail = _task_url_parts("edit_task_form")
+
+    def build():
+        # yield_per: lotes de 200 linhas viram um pedaço do array JSON cada
+        result = db.session.execute(q.limit(CALENDAR_MAX_EVENTS).execution_options(yield_per=200))
+        chunks = []
+        sep = b"["
+        for part in result.partitions():
+            # start: datetime cru; o orjson sem microssegundos dá o mesmo "%Y-%m-%dT%H:%M:%S" do strftime
+            chunk = sep + b",".join(orjson.dumps({
+                "id": r.id,
+                "title": r.cal_title,
+                "start": r.due_date,
+                "url": f"{url_head}{r.id}{url_tail}",
+                "status": r.status,
+                "classNames": _CAL_CLASSES.get(r.status, _CAL_CLASS_DEFAULT),
+            }, option=orjson.OPT_OMIT_MICROSECONDS) for r in part)
+            chunks.append(chunk)
+            yield chunk
+            sep = b","
+        chunk = b"]" if sep == b"," else b"[]"
+        chunks.append(chunk)
+        yield chunk
+        # só guarda o corpo que saiu inteiro
+        if len(_cal_cache) >= CALENDAR_CACHE_MAX:
+            _cal_cache.clear()
+        body = b"".join(chunks)
+        # a versão gzip sai uma vez por janela, não a cada hit
+        gz = _gzip_bytes(body) if len(body) >= GZIP_MIN_SIZE else None
+        _cal_cache[key] = (time.monotonic() + CALENDAR_CACHE_TTL, body, gz, truncated)
+
+    resp = _json_if_changed(version, build, stream=True)
+    if resp.status_code == 200:
+        # o corpo sai em stream, então o aviso de corte vai no cabeçalho; a sonda só
+        # percorre o índice até a posição do teto, sem montar linha nenhuma
+        probe = q.with_only_columns(Task.id).offset(CALENDAR_MAX_EVENTS).limit(1)
+        truncated = db.session.execute(probe).first() is not None
+        if truncated:
+            resp.headers["X-Calendar-Truncated"] = str(CALENDAR_MAX_EVENTS)
+    return resp
 
 @app.route("/calendar")
 def calendar_view():
@@ -1016,9 +1502,12 @@ def calendar_view():
         return redirect(url_for("login"))
     u = current_user()
     admin = is_admin()
-    users_list = User.query.order_by(User.username.asc()).all() if admin else []
-    # Renderiza template externo em templates/calendar.html
-    return render_template("calendar.html", user=u, is_admin=admin, users=users_list)
+    users_list = _users_list() if admin else []
+    # só usuário, papel e lista do <select> variam; o resto do HTML é fixo
+    return _html_if_changed(
+        (tuple(u), admin, tuple(map(tuple, users_list))),
+        lambda: render_template("calendar.html", user=u, is_admin=admin, users=users_list, fc_local=_FC_LOCAL),
+    )
 
 # =============================
 # HEALTH / UTILS
@@ -1027,12 +1516,29 @@ def calendar_view():
 def health():
     return jsonify({"status": "ok"}), 200
 
-@app.after_request
-def add_cors_headers(resp):
-    resp.headers['Access-Control-Allow-Origin'] = '*'
-    resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Panel-Token'
-    resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-    return resp
+# só a API (e o health check) é chamada de outra origem pela extensão
+_CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Panel-Token'),
+    ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+)
+
+class _CorsMiddleware:
+    # cabeçalhos fixos acrescentados no start_response: nada por resposta no Flask
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if not (path.startswith("/api/") or path == "/health"):
+            return self.wsgi_app(environ, start_response)
+
+        def _start(status, headers, exc_info=None):
+            headers.extend(_CORS_HEADERS)
+            return start_response(status, headers, exc_info)
+        return self.wsgi_app(environ, _start)
+
+app.wsgi_app = _CorsMiddleware(app.wsgi_app)
 
 @app.errorhandler(500)
 def internal_error(e):
@@ -1040,6 +1546,13 @@ def internal_error(e):
     traceback.print_exc()
     return "Erro interno no servidor (500). Veja o terminal.", 500
 
+# compila os templates de arquivo já no import (depois dos filtros registrados acima):
+# o primeiro request não paga o parse; PANEL_SKIP_PRECOMPILE=1 deixa para a 1ª renderização
+# (scripts que só importam o módulo). Os templates inline (_TPL_*) são compilados sempre.
+if not os.environ.get("PANEL_SKIP_PRECOMPILE"):
+    for _tpl_name in ("login.html", "user_tasks.html", "calendar.html"):
+        app.jinja_env.get_template(_tpl_name)
+
 # =============================
 # MAIN
 # =============================
@@ -1047,4 +1560,7 @@ if __name__ == "__main__":
     with app.app_context():
         init_db()
     print(f"DB em: {db_path}")
-    app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
+    # cada cliente SSE ocupa uma thread esperando o Event do assinante (ping a cada SSE_KEEPALIVE s
+    # derruba socket morto); pilha menor = clientes ociosos mais baratos
+    threading.stack_size(1024 * 1024)
+    app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False, threaded=True)